@@ -1,7 +1,18 @@
 from flask import Flask, Response
-from prometheus_client import CollectorRegistry, Gauge, generate_latest
+from waitress import serve
+from apscheduler.schedulers.background import BackgroundScheduler
+from prometheus_client import CollectorRegistry, generate_latest, CONTENT_TYPE_LATEST
+from prometheus_client.core import GaugeMetricFamily
+from types import MappingProxyType
+from collections import Counter
+from datetime import datetime
 from urllib.parse import urlparse
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import time
+import random
+import orjson
+import ijson
 import requests
 import os
 import sys
@@ -17,8 +28,8 @@ requests.packages.urllib3.disable_warnings(requests.packages.urllib3.exceptions.
 This Python Flask web app connects to the TAS API and generates a Prometheus metric called `cf_stack_count`.
 The label `stack` dictates a count of how many applications are running that stack.
 
-The metrics gathering occurs in a threaded loop as it takes awhile (~10-20 seconds) which is too long
-for Prometheus to wait for, so we instead serve the latest metrics that have been gathered from the loop.
+The metrics gathering occurs in a scheduled background job as it takes awhile (~10-20 seconds) which is too long
+for Prometheus to wait for, so we instead serve the latest metrics that have been gathered by the job.
 
 This Flask app needs three environment variables:
 
@@ -31,6 +42,7 @@ SCRAPE_INTERVAL which dictates how often we hit the CF API for updated metrics i
 LOG_LEVEL which controls verbosity for debugging purposes. By default it's INFO (pretty quiet)
 SKIP_SSL_VERIFY for whether or not to skip SSL validation. By default it's False (validates SSL)
 INCLUDE_INVALID_STACKS to control whether or not we report stacks that are invalid (i.e typos from developers)
+HTTP_WORKERS which sets how many pages of apps are fetched concurrently. By default it's 16
 """
 
 app = Flask(__name__)
@@ -39,8 +51,9 @@ registry = CollectorRegistry()
 def str2bool(val):
   return str(val).lower() in ("yes", "true", "t", "1")
 
-# Setup logging, including disabling the wekzeug access logs, as CF already does this for us
-logging.getLogger("werkzeug").disabled = True
+# Setup logging, including quieting APScheduler's INFO line on every job run. Waitress writes no access logs,
+# which is what we want as CF already does this for us
+logging.getLogger("apscheduler").setLevel(logging.WARNING)
 log_level = os.getenv('LOG_LEVEL', 'INFO').upper()
 logging.basicConfig(stream=sys.stdout, format='[%(levelname)s] [%(name)s] %(message)s',level=log_level)
 logger = logging.getLogger("StackExporter")
@@ -48,9 +61,12 @@ logger = logging.getLogger("StackExporter")
 # End program if these envvars aren't available, we can't assume them
 REQUIRED_ENV_VARS = ["CF_API_URL", "CF_USERNAME", "CF_PASSWORD"]
 
-# We'll get these two dynamically
+# We'll get these dynamically. The token is refreshed a minute before it expires; until the
+# first login there's nothing to refresh, hence infinity
 CF_UAA_URL = ""
 CF_AUTH_TOKEN = ""
+TOKEN_EXPIRES_AT = float("inf")
+token_lock = threading.Lock()
 
 # Various environment variables used throughout the scraper
 CF_API_URL = os.getenv("CF_API_URL")
@@ -58,16 +74,60 @@ CF_USERNAME = os.getenv("CF_USERNAME")
 CF_PASSWORD = os.getenv("CF_PASSWORD")
 SCRAPE_INTERVAL = int(os.getenv("SCRAPE_INTERVAL", "300"))
 SKIP_SSL_VALIDATION = str2bool(os.getenv("SKIP_SSL_VERIFY", False))
+VERIFY_TLS = not SKIP_SSL_VALIDATION
 INCLUDE_INVALID_STACKS = str2bool(os.getenv("INCLUDE_INVALID_STACKS", False))
+HTTP_WORKERS = int(os.getenv("HTTP_WORKERS", "16"))
 PORT = os.getenv("PORT", "8080")
 
+# Connect and read timeouts for every CF API and UAA call
+HTTP_TIMEOUT = (5, 30)
+
+# Re-fetch the list of valid stacks once an hour, so newly installed stacks are picked up without restarting the exporter
+STACK_REFRESH_SECONDS = 3600
+
+# How many times a scrape tries to fetch the first page of apps before giving up until the next run
+FETCH_ATTEMPTS = 5
+
+# Largest page size the CF v3 API allows, fewer pages means fewer round-trips per scrape
+APPS_PER_PAGE = 5000
+
+# Shared HTTP session so every call (including the threaded page fetches) reuses pooled keep-alive connections
+SESSION = requests.Session()
+adapter = HTTPAdapter(pool_connections=HTTP_WORKERS, pool_maxsize=HTTP_WORKERS,
+                      max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504]))
+SESSION.mount("https://", adapter)
+SESSION.mount("http://", adapter)
+# Advertise compression explicitly; urllib3 transparently decodes brotli (via the brotli package) and gzip
+SESSION.headers.update({"Accept": "application/json", "Accept-Encoding": "br, gzip, deflate"})
+
+# Long-lived worker pool for page fetches, sized to match the connection pool so no sockets get discarded
+EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=HTTP_WORKERS, thread_name_prefix="cf-fetch")
+
+# Cached metrics and set of valid stacks. The cache is only ever replaced wholesale with a read-only
+# snapshot, so readers can grab the reference without a lock and never see a half-built dict
+stack_cache = MappingProxyType({})
+valid_stacks = frozenset()
+stacks_refreshed_at = 0.0
+
+# ETags and parsed results from previous responses, keyed by URL, so unchanged pages can be served from a 304
+etag_cache = {}
+body_cache = {}
+
+
+class StackCollector:
+    # Builds the gauge from whatever snapshot is current at scrape time, so stale stacks disappear on their own
+    def collect(self):
+        snapshot = stack_cache
+        gauge = GaugeMetricFamily("cf_stack_count", "Total number of apps using each stack", labels=["stack"])
+        for stack, count in snapshot.items():
+            gauge.add_metric([stack], count)
+        yield gauge
+
 # Prometheus gauge creation
-stack_gauge = Gauge("cf_stack_count", "Total number of apps using each stack", ["stack"], registry=registry)
+registry.register(StackCollector())
 
-# Cached metrics, array of valid stacks, and a mutex to prevent collisions
-stack_cache = {}
-cache_lock = threading.Lock()
-valid_stacks = []
+# The exposition text only changes when a scrape publishes new counts, so it's rendered then and served as-is
+metrics_payload = generate_latest(registry)
 
 
 def validate_env_vars():
@@ -90,20 +150,20 @@ def grab_valid_stacks():
     # This is necessary because people can put whatever they want under 'stack' in their manifest,
     # and we don't want to mess up the data from people's mistakes.
     # TODO: Maybe create an 'invalid' metric to tally how many invalid stacks are being requested?
+    # The set is rebuilt and swapped in whole, so scrapes reading it never see a partial list.
 
-    global valid_stacks
+    global valid_stacks, stacks_refreshed_at
     stacks_endpoint = f"{CF_API_URL}/v3/stacks"
     stack_list = api_call(stacks_endpoint)
 
-    for stack in stack_list['resources']:
-        logger.debug(f"Adding {stack} to valid list")
-        valid_stacks.append(stack['name'])
-    
+    valid_stacks = frozenset(stack['name'] for stack in stack_list['resources'])
+    stacks_refreshed_at = time.monotonic()
+
     logger.info(f"Valid stack list is: {valid_stacks}")
 
 
 def get_token():
-    global CF_AUTH_TOKEN
+    global CF_AUTH_TOKEN, TOKEN_EXPIRES_AT
 
     auth_endpoint = f"{CF_UAA_URL}/oauth/token"
     headers = {"Accept": "application/json", 
@@ -111,113 +171,160 @@ def get_token():
                "Content-Type'": "application/x-www-form-urlencoded"
                }
 
-    response = requests.post(auth_endpoint, data={
+    response = SESSION.post(auth_endpoint, data={
         "grant_type": "password",
         "client_id": "cf",
         "username": CF_USERNAME,
         "password": CF_PASSWORD
-    }, headers=headers, verify=SKIP_SSL_VALIDATION)
+    }, headers=headers, verify=VERIFY_TLS, timeout=HTTP_TIMEOUT)
 
 
     response.raise_for_status()
-    CF_AUTH_TOKEN = response.json()["access_token"]
+    token = response.json()
+    CF_AUTH_TOKEN = token["access_token"]
+    TOKEN_EXPIRES_AT = time.monotonic() + token["expires_in"] - 60
+    SESSION.headers["Authorization"] = f"Bearer {CF_AUTH_TOKEN}"
 
     logger.debug(f"Token fetched: {CF_AUTH_TOKEN}")
     return
 
 
+def refresh_token_if_expiring():
+    if time.monotonic() < TOKEN_EXPIRES_AT:
+        return
+
+    # Check again once we hold the lock, another thread may have already refreshed it
+    with token_lock:
+        if time.monotonic() >= TOKEN_EXPIRES_AT:
+            logger.debug("Token is about to expire, refreshing")
+            get_token()
+
+
+def fetch(url, parse, stream=False):
+    refresh_token_if_expiring()
+    # Runs for every page, so debug logging is lazily formatted and auth comes from SESSION.headers
+    logger.debug("Fetching API: %s", url)
+    headers = {"If-None-Match": etag_cache[url]} if url in etag_cache else None
+    with SESSION.get(url, headers=headers, verify=VERIFY_TLS, timeout=HTTP_TIMEOUT, stream=stream) as response:
+        response.raise_for_status()
+
+        if response.status_code == 304:
+            logger.debug("Not modified, reusing cached body: %s", url)
+            return body_cache[url]
+
+        body = parse(response)
+        etag = response.headers.get("ETag")
+
+    if etag:
+        # Store the body before the ETag so another thread never sends an ETag we have no body for
+        body_cache[url] = body
+        etag_cache[url] = etag
+    return body
+
+
+def parse_json(response):
+    return orjson.loads(response.content)
+
+
 def api_call(url):
-    global CF_AUTH_TOKEN
-    headers = {"Authorization": f"Bearer {CF_AUTH_TOKEN}"}
-    logger.debug(f"Fetching API: {url}")
-    response = requests.get(url, headers=headers, verify=SKIP_SSL_VALIDATION)
-    response.raise_for_status()
-    return response.json()
+    return fetch(url, parse_json)
 
 
-def generate_stack_metrics():
-    global stack_cache
-    while True:
-        try:
-            apps_endpoint = f"{CF_API_URL}/v3/apps"
-            stack_counts = {}
-            apps_count = 0
-            retries = 0
-
-            while apps_count == 0:
-                if retries >= 5:
-                    logger.error(f"Quitting iteration after 5 attempts to authenticate to UAA.")
-                    raise Exception
-                try:
-                    apps_count = api_call(apps_endpoint)
-                except requests.exceptions.RequestException as err:
-                    if err.response is None:
-                        logger.error(f"Error while enumerating applications: {err}")
-                        time.sleep(5)
-                        retries += 1
-                        continue
-                    elif err.response.status_code == 403 or err.response.status_code == 401:
-                        logger.error(f"Token not valid, attempting re-login")
-                        get_token()
-                        time.sleep(5)
-                        retries += 1
-                        continue
-                    else:
-                        logger.error(f"Error while enumerating applications: {err}")
-                        time.sleep(5)
-                        retries += 1
-                        continue
-                except Exception as err:
-                        logger.error(f"Error while enumerating applications: {err}")
-                        time.sleep(5)
-                        retries += 1
-                        continue
-                    
-
-            logger.debug(f"Pagination data: {apps_count['pagination']}")
-            apps_count = apps_count["pagination"]["total_pages"]
-            logger.debug(f"There are {apps_count} pages to iterate through")
-
-            all_urls = []
-            for page in range(1, apps_count+1):
-                all_urls.append(f"{apps_endpoint}?page={page}&per_page=50")
-
-            logger.debug(f"Total URLs mapped for threading: {all_urls}")
-            with concurrent.futures.ThreadPoolExecutor() as exec:
-                responses = list(exec.map(api_call, all_urls))
-
-            for response in responses:
-                for app in response.get("resources", []):
-                    stack = app.get("lifecycle", {}).get("data", {}).get("stack")
-                    if stack:
-                        if INCLUDE_INVALID_STACKS or stack in valid_stacks:
-                            stack_counts[stack] = stack_counts.get(stack, 0) + 1
-                        else:
-                            logger.debug(f"Discarding {stack} as it's not in list: {valid_stacks}")
-            
-            logger.info(f"Current metrics: {stack_counts}")
-            with cache_lock:
-                stack_cache = stack_counts
+def parse_apps_page(response):
+    # Walk the (decompressed) body as a stream of JSON events instead of loading it, so we never hold
+    # the whole page or build a dict per app. All we need is the page count and each app's stack.
+    response.raw.decode_content = True
+    total_pages = 0
+    stacks = Counter()
+    for prefix, event, value in ijson.parse(response.raw):
+        if prefix == "resources.item.lifecycle.data.stack" and event == "string":
+            if value:
+                stacks[value] += 1
+        elif prefix == "pagination.total_pages" and event == "number":
+            total_pages = value
+    return total_pages, stacks
+
+
+def apps_page(url):
+    return fetch(url, parse_apps_page, stream=True)
+
+
+def apps_page_url(page):
+    # /v3/apps has no sparse fieldset for lifecycle (fields[] only applies to included resources),
+    # so the page size is the only lever we have on response size
+    return f"{CF_API_URL}/v3/apps?page={page}&per_page={APPS_PER_PAGE}"
 
+
+def backoff(retries):
+    # Exponential backoff with jitter (1s, 2s, 4s, ...) capped at 30 seconds. Nothing to wait for after the last attempt
+    if retries >= FETCH_ATTEMPTS:
+        return
+    time.sleep(min(30, 2**(retries-1) + random.uniform(0, 1)))
+
+
+def scrape_once():
+    global stack_cache, metrics_payload
+    if not INCLUDE_INVALID_STACKS and time.monotonic() - stacks_refreshed_at >= STACK_REFRESH_SECONDS:
+        try:
+            grab_valid_stacks()
         except Exception as err:
-            logger.error(f"Error while fetching metrics: {err}")
-            time.sleep(SCRAPE_INTERVAL)
-            continue
-        
-        logger.info("Successfully scraped CF API")
-        time.sleep(SCRAPE_INTERVAL)
+            logger.error(f"Error while refreshing valid stacks, keeping the previous list: {err}")
+
+    try:
+        first_page = None
+        retries = 0
+
+        while first_page is None:
+            if retries >= FETCH_ATTEMPTS:
+                logger.error(f"Quitting iteration after {FETCH_ATTEMPTS} failed attempts to enumerate applications.")
+                raise Exception
+            try:
+                first_page = apps_page(apps_page_url(1))
+            except requests.exceptions.RequestException as err:
+                retries += 1
+                if err.response is not None and err.response.status_code in (401, 403):
+                    # A fresh token fixes this straight away, no point waiting before retrying
+                    logger.error(f"Token not valid, attempting re-login")
+                    get_token()
+                    continue
+                logger.error(f"Error while enumerating applications: {err}")
+                backoff(retries)
+            except Exception as err:
+                retries += 1
+                logger.error(f"Error while enumerating applications: {err}")
+                backoff(retries)
+
+        total_pages = first_page[0]
+        logger.debug(f"There are {total_pages} pages to iterate through")
+
+        # The first page has already been fetched, so only the remaining pages need to be requested
+        all_urls = [apps_page_url(page) for page in range(2, total_pages+1)]
+
+        logger.debug("Total URLs mapped for threading: %s", all_urls)
+        pages = [first_page] + list(EXECUTOR.map(apps_page, all_urls))
+
+        all_stacks = Counter()
+        for _, stacks in pages:
+            all_stacks.update(stacks)
+        if INCLUDE_INVALID_STACKS:
+            stack_counts = dict(all_stacks)
+        else:
+            stack_counts = {stack: count for stack, count in all_stacks.items() if stack in valid_stacks}
+
+        logger.info(f"Current metrics: {stack_counts}")
+        stack_cache = MappingProxyType(stack_counts)
+        metrics_payload = generate_latest(registry)
+
+    except Exception as err:
+        logger.error(f"Error while fetching metrics: {err}")
+        return
+
+    logger.info("Successfully scraped CF API")
+
 
 @app.route("/metrics")
 def metrics():
-    local_cache = {}
-
-    with cache_lock:
-        local_cache = stack_cache.copy()
-
-    for stack, count in local_cache.items():
-        stack_gauge.labels(stack=stack).set(count)
-    
-    return Response(generate_latest(registry), mimetype="text/plain")
+    return Response(metrics_payload, content_type=CONTENT_TYPE_LATEST)
 
 
 if __name__ == "__main__":
@@ -228,5 +335,11 @@ if __name__ == "__main__":
         logger.info("Including all stacks, including invalid ones as INCLUDE_INVALID_STACKS is set to True")
     else:
         grab_valid_stacks()
-    threading.Thread(target=generate_stack_metrics, daemon=True).start()
-    app.run(host="0.0.0.0", port=PORT)
\ No newline at end of file
+
+    # Run the first scrape right away, then every SCRAPE_INTERVAL. A scrape that overruns the interval
+    # causes the next run to be skipped rather than stacked up, and a failed run doesn't stop the schedule
+    scheduler = BackgroundScheduler()
+    scheduler.add_job(scrape_once, "interval", seconds=SCRAPE_INTERVAL, max_instances=1, coalesce=True,
+                      next_run_time=datetime.now())
+    scheduler.start()
+    serve(app, host="0.0.0.0", port=int(PORT), threads=4)
\ No newline at end of file